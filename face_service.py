@@ -2,12 +2,21 @@ from flask import Flask, request, jsonify
 import cv2
 import numpy as np
 import base64
+import hashlib
+import itertools
+import shutil
+import tempfile
 import os
 import time
 import mediapipe as mp
 from ultralytics import YOLO
-from collections import defaultdict
+import torch
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
 import logging
+import threading
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
 
 app = Flask(__name__)
 
@@ -16,10 +25,53 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- VIOLATION TRACKING ---
-# Store violation counts for each user. In a real app, use a database.
+# Store violation counts for each user. Set REDIS_URL to share the counts
+# between worker processes; otherwise they live in this process only.
 violation_counts = defaultdict(int)
+violation_counts_lock = threading.Lock()
 MAX_VIOLATIONS = 10  # Increased to match the Go backend
 
+# Redis calls must fail well within gunicorn's 30 s worker timeout
+REDIS_TIMEOUT_SECONDS = 1.0
+# Counts expire after this long without a new violation, so they don't
+# carry over from one exam to the next
+VIOLATION_TTL_SECONDS = int(os.environ.get("VIOLATION_TTL_SECONDS", 4 * 60 * 60))
+
+redis_client = None
+if os.environ.get("REDIS_URL"):
+    try:
+        import redis
+        redis_client = redis.Redis.from_url(
+            os.environ["REDIS_URL"],
+            socket_timeout=REDIS_TIMEOUT_SECONDS,
+            socket_connect_timeout=REDIS_TIMEOUT_SECONDS
+        )
+        logger.info("Using Redis for violation counts")
+    except ImportError:
+        logger.error("REDIS_URL is set but the redis package is not installed, using in-process counts")
+    except ValueError as e:
+        logger.error(f"Invalid REDIS_URL, using in-process counts: {e}")
+
+def record_violation(username):
+    """
+    Atomically increment the violation count for a user
+    Returns the new count
+    """
+    if redis_client is not None:
+        key = f"viol:{username}"
+        try:
+            pipe = redis_client.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, VIOLATION_TTL_SECONDS)
+            count, _ = pipe.execute()
+            return count
+        except redis.RedisError as e:
+            # Don't lose the violation; count it in this process instead
+            logger.error(f"Redis error counting violation for {username}, using in-process count: {e}")
+    with violation_counts_lock:
+        violation_counts[username] += 1
+        return violation_counts[username]
+
 # --- MediaPipe Setup ---
 mp_face_mesh = mp.solutions.face_mesh
 # Using refined landmarks around the eyes for better accuracy
@@ -30,17 +82,152 @@ RIGHT_EYE_INDICES = [33, 7, 163, 144, 145, 153, 154, 155, 133, 173, 157, 158, 15
 LEFT_IRIS_CENTER = 473
 RIGHT_IRIS_CENTER = 468
 
+# Long-lived FaceMesh instances shared by every request. Building a FaceMesh
+# loads the TFLite graph, so we do it once at import time. static_image_mode
+# keeps frames from different users from being treated as one video stream,
+# and the locks serialise access since the interpreter is not re-entrant.
+FACE_MESH_1 = mp_face_mesh.FaceMesh(
+    static_image_mode=True,
+    max_num_faces=1,
+    refine_landmarks=True,
+    min_detection_confidence=0.5,
+    min_tracking_confidence=0.5
+)
+FACE_MESH_5 = mp_face_mesh.FaceMesh(
+    static_image_mode=True,
+    max_num_faces=5,
+    refine_landmarks=True,
+    min_detection_confidence=0.5,
+    min_tracking_confidence=0.5
+)
+FACE_MESH_1_LOCK = threading.Lock()
+FACE_MESH_5_LOCK = threading.Lock()
+
+def process_face_mesh(rgb_image, max_faces=1):
+    """
+    Run the shared FaceMesh on an RGB image
+    Returns the MediaPipe results object
+    """
+    if max_faces > 1:
+        with FACE_MESH_5_LOCK:
+            return FACE_MESH_5.process(rgb_image)
+    with FACE_MESH_1_LOCK:
+        return FACE_MESH_1.process(rgb_image)
+
 # --- Gaze Detection Thresholds ---
 HORIZONTAL_THRESHOLD = 0.35  # Adjusted threshold for better accuracy
 
 # --- Object Detection Setup ---
 # Download YOLO model if it doesn't exist
-try:
-    model = YOLO('yolov8n.pt')
-    logger.info("YOLO model loaded successfully")
-except Exception as e:
-    logger.error(f"Error loading YOLO model: {e}")
-    model = None
+# Run on the GPU in half precision when one is available
+YOLO_DEVICE = 0 if torch.cuda.is_available() else 'cpu'
+YOLO_HALF = YOLO_DEVICE != 'cpu'
+YOLO_IMGSZ = 320  # Coarse detection is enough for proctoring
+MAX_BATCH = 8  # Largest micro-batch sent to the model at once
+
+# Optionally run an exported model instead of PyTorch: YOLO_EXPORT_FORMAT=openvino
+# (fastest on CPU) or YOLO_EXPORT_FORMAT=engine (TensorRT on NVIDIA GPUs).
+# The export is a separate one-time step (make yolo-export); at startup the
+# service only loads an export that already exists.
+YOLO_EXPORT_FORMAT = os.environ.get("YOLO_EXPORT_FORMAT", "").lower()
+YOLO_EXPORT_PATHS = {
+    'openvino': 'yolov8n_openvino_model',
+    'engine': 'yolov8n.engine',
+}
+
+def export_yolo_model(export_format):
+    """
+    Export yolov8n.pt to export_format for YOLO_EXPORT_FORMAT to load
+    The export is built in a temporary directory and renamed into place,
+    so a running service never sees a half-written export
+    """
+    export_path = YOLO_EXPORT_PATHS[export_format]
+    with tempfile.TemporaryDirectory(dir=".") as tmp_dir:
+        # ultralytics writes the export next to the weights file
+        tmp_weights = shutil.copy('yolov8n.pt', tmp_dir)
+        tmp_export = YOLO(tmp_weights).export(
+            format=export_format,
+            half=YOLO_HALF,
+            imgsz=YOLO_IMGSZ,
+            dynamic=True,
+            batch=MAX_BATCH,
+            device=YOLO_DEVICE
+        )
+        if os.path.isdir(export_path):
+            shutil.rmtree(export_path)
+        os.replace(tmp_export, export_path)
+    logger.info(f"YOLO model exported to {export_path}")
+    return export_path
+
+model = None
+if YOLO_EXPORT_FORMAT:
+    export_path = YOLO_EXPORT_PATHS.get(YOLO_EXPORT_FORMAT)
+    if export_path is None:
+        logger.error(f"Unknown YOLO_EXPORT_FORMAT: {YOLO_EXPORT_FORMAT}")
+    elif not os.path.exists(export_path):
+        logger.error(f"No {YOLO_EXPORT_FORMAT} export at {export_path}, run make yolo-export; falling back to PyTorch")
+    else:
+        try:
+            model = YOLO(export_path)
+            logger.info(f"YOLO model loaded successfully from {YOLO_EXPORT_FORMAT} export")
+        except Exception as e:
+            logger.error(f"Error loading exported YOLO model, falling back to PyTorch: {e}")
+
+if model is None:
+    try:
+        model = YOLO('yolov8n.pt')
+        if YOLO_DEVICE != 'cpu':
+            model.to('cuda')
+        logger.info(f"YOLO model loaded successfully on {'cuda' if YOLO_HALF else 'cpu'}")
+    except Exception as e:
+        logger.error(f"Error loading YOLO model: {e}")
+        model = None
+
+# Shared pool for running compare_faces next to YOLO. Sized to the gunicorn
+# threads per worker so every in-flight request can get a pool thread.
+DETECTOR_POOL_WORKERS = int(os.environ.get("GUNICORN_THREADS", 8))
+detector_pool = ThreadPoolExecutor(max_workers=DETECTOR_POOL_WORKERS)
+
+# --- YOLO Micro-Batching ---
+# Concurrent requests post their frames to a queue; a single worker thread
+# runs them through YOLO together so the per-call overhead is shared.
+MAX_BATCH_WAIT_MS = 20
+yolo_queue = queue.Queue()
+
+def yolo_batch_worker():
+    while True:
+        batch = [yolo_queue.get()]
+        deadline = time.monotonic() + MAX_BATCH_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(yolo_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        images = [image for image, _ in batch]
+        try:
+            results = model(images, verbose=False, conf=0.5, device=YOLO_DEVICE, half=YOLO_HALF, imgsz=YOLO_IMGSZ)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            continue
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+def submit_yolo(image):
+    """
+    Queue an image for batched YOLO inference
+    Returns a Future resolving to the ultralytics Results for that image
+    """
+    future = Future()
+    yolo_queue.put((image, future))
+    return future
+
+if model is not None:
+    threading.Thread(target=yolo_batch_worker, daemon=True).start()
 
 # Define prohibited items (COCO dataset class names)
 PROHIBITED_ITEMS = {
@@ -56,78 +243,187 @@ PROHIBITED_ITEMS = {
 # --- Existing Setup ---
 os.makedirs("captured_images", exist_ok=True)
 
-def save_image_from_base64(data_url):
+# Captured frames are written to disk by a background thread so the
+# request never waits on the filesystem. Set DISABLE_IMAGE_ARCHIVE=1 to
+# skip storing them at all.
+ARCHIVE_IMAGES = os.environ.get("DISABLE_IMAGE_ARCHIVE", "") not in ("1", "true")
+archive_queue = queue.Queue()
+archive_sequence = itertools.count()
+
+# File extension for each image MIME type the frontend may send
+IMAGE_EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/webp': 'webp',
+}
+
+def archive_writer():
+    while True:
+        filename, raw = archive_queue.get()
+        try:
+            with open(filename, "wb") as f:
+                f.write(raw)
+        except OSError as e:
+            logger.error(f"Error archiving image {filename}: {e}")
+
+if ARCHIVE_IMAGES:
+    threading.Thread(target=archive_writer, daemon=True).start()
+
+def image_extension(data_url):
+    # "data:image/jpeg;base64,..." -> "jpg"
+    mime = data_url.split(",", 1)[0].split(":", 1)[-1].split(";", 1)[0]
+    return IMAGE_EXTENSIONS.get(mime.lower(), 'png')
+
+def archive_image(raw, extension):
+    if not ARCHIVE_IMAGES:
+        return None
+    # The per-process sequence number guarantees unique names even if two
+    # threads read the same clock value or the clock steps backwards; the
+    # pid separates gunicorn workers
+    filename = f"captured_images/{time.time_ns()}_{os.getpid()}_{next(archive_sequence)}.{extension}"
+    archive_queue.put((filename, raw))
+    return filename
+
+# Frames are downscaled once at ingress so that no detector works on more
+# pixels than it needs. 640 keeps the common 640x480 webcam frame as is,
+# which the pixel thresholds in the headset check were tuned on.
+ANALYSIS_MAX_SIDE = 640
+
+def resize_for_analysis(image):
+    h, w = image.shape[:2]
+    scale = ANALYSIS_MAX_SIDE / max(h, w)
+    if scale >= 1:
+        return image
+    # Keep at least one pixel on each side for very thin frames
+    size = (max(1, int(w * scale)), max(1, int(h * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def decode_image_from_base64(data_url):
+    """
+    Decode a base64 data URL straight into a BGR image at analysis resolution
+    Returns (image, raw_bytes), or (None, None) if the data is invalid
+    The raw bytes are the original upload, at full resolution
+    """
     parts = data_url.split(",")
     if len(parts) != 2:
+        return None, None
+    try:
+        raw = base64.b64decode(parts[1], validate=True)
+    except ValueError:
+        return None, None
+    if not raw:
+        return None, None  # cv2.imdecode raises on an empty buffer
+    image = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None, None
+    return resize_for_analysis(image), raw
+
+# Both faces are resized to this size before template matching
+MATCH_SIZE = (128, 128)
+MATCH_THRESHOLD = 0.7
+
+def to_match_size(gray):
+    return cv2.resize(gray, MATCH_SIZE, interpolation=cv2.INTER_AREA)
+
+def normalized_cross_correlation(a, b):
+    """
+    Same score as cv2.matchTemplate(TM_CCOEFF_NORMED) for two images of equal size
+    """
+    a = a.astype(np.float32)
+    b = b.astype(np.float32)
+    a -= a.mean()
+    b -= b.mean()
+    denom = np.sqrt((a * a).sum() * (b * b).sum())
+    if denom == 0:
+        return 0.0  # Flat image, no usable signal
+    return float((a * b).sum() / denom)
+
+@lru_cache(maxsize=64)
+def _load_reference_face(ref_path, mtime):
+    # Only the small grayscale copy is cached, not the full-resolution image
+    ref_gray = cv2.imread(ref_path, cv2.IMREAD_GRAYSCALE)
+    if ref_gray is None:
+        return None
+    return to_match_size(ref_gray)
+
+def _reference_mtime(ref_path):
+    # Cache entries are keyed on the modification time so a re-registered face is reloaded
+    try:
+        return os.path.getmtime(ref_path)
+    except OSError:
         return None
-    decoded = base64.b64decode(parts[1])
-    timestamp = time.strftime("%Y%m%d_%H%M%S")
-    filename = f"captured_images/{timestamp}.png"
-    with open(filename, "wb") as f:
-        f.write(decoded)
-    return filename
 
-def compare_faces(ref_path, curr_path):
+def load_reference_face(ref_path):
     """
-    Compare two faces using template matching and face landmarks
-    Returns True if faces match, otherwise False
+    Load a reference face as a downscaled grayscale image, cached in memory
+    Returns ref_small, or None if the image cannot be read
     """
+    mtime = _reference_mtime(ref_path)
+    if mtime is None:
+        return None
+    return _load_reference_face(ref_path, mtime)
+
+# Key facial features compared by the landmark fallback: nose tip, eye corners, mouth corners
+KEY_IDX = np.array([1, 33, 263, 61, 291, 13, 14], dtype=np.int32)
+
+def _key_coords(landmarks):
+    return np.array([(landmarks[i].x, landmarks[i].y) for i in KEY_IDX], dtype=np.float32)
+
+@lru_cache(maxsize=64)
+def _load_reference_key_coords(ref_path, mtime):
+    # Read once from disk; only the resulting coordinates are cached
     ref_img = cv2.imread(ref_path)
-    curr_img = cv2.imread(curr_path)
+    if ref_img is None:
+        return None
+    multi_face_landmarks = get_face_landmarks(resize_for_analysis(ref_img))
+    if not multi_face_landmarks:
+        return None
+    return _key_coords(multi_face_landmarks[0].landmark)
+
+def load_reference_key_coords(ref_path):
+    """
+    Key landmark coordinates of a reference face, cached in memory
+    Returns an (N, 2) float32 array, or None if no face is found
+    """
+    mtime = _reference_mtime(ref_path)
+    if mtime is None:
+        return None
+    return _load_reference_key_coords(ref_path, mtime)
+
+def compare_faces(ref_path, curr_img, frame_key=None):
+    """
+    Compare the reference face on disk with the current BGR image
+    using template matching and face landmarks
+    Returns True if faces match, otherwise False
+    """
+    ref_small = load_reference_face(ref_path)
     
-    if ref_img is None or curr_img is None:
+    if ref_small is None or curr_img is None:
         return False
 
-    # Convert to grayscale
-    ref_gray = cv2.cvtColor(ref_img, cv2.COLOR_BGR2GRAY)
-    curr_gray = cv2.cvtColor(curr_img, cv2.COLOR_BGR2GRAY)
+    # Convert to grayscale (the reference is already cached in grayscale)
+    curr_small = to_match_size(cv2.cvtColor(curr_img, cv2.COLOR_BGR2GRAY))
 
-    # Use template matching as a first check
-    res = cv2.matchTemplate(curr_gray, ref_gray, cv2.TM_CCOEFF_NORMED)
-    _, max_val, _, _ = cv2.minMaxLoc(res)
+    # Use template matching as a first check. Both images have the same size
+    # after downscaling, so the match collapses to a single correlation score
+    max_val = normalized_cross_correlation(curr_small, ref_small)
     
     # If template matching score is high enough, consider it a match
-    if max_val >= 0.7:
+    if max_val >= MATCH_THRESHOLD:
         return True
     
     # If template matching is inconclusive, use face landmarks for more accurate comparison
-    with mp_face_mesh.FaceMesh(
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5
-    ) as face_mesh:
-        # Get landmarks for both images
-        ref_rgb = cv2.cvtColor(ref_img, cv2.COLOR_BGR2RGB)
-        curr_rgb = cv2.cvtColor(curr_img, cv2.COLOR_BGR2RGB)
-        
-        ref_results = face_mesh.process(ref_rgb)
-        curr_results = face_mesh.process(curr_rgb)
+    ref_coords = load_reference_key_coords(ref_path)
+    # Use the 5-face mesh so the result is shared with the later checks on this frame
+    curr_landmarks = get_face_landmarks(curr_img, max_faces=5, frame_key=frame_key)
+    
+    if ref_coords is not None and curr_landmarks:
+        curr_coords = _key_coords(curr_landmarks[0].landmark)
         
-        if ref_results.multi_face_landmarks and curr_results.multi_face_landmarks:
-            ref_landmarks = ref_results.multi_face_landmarks[0].landmark
-            curr_landmarks = curr_results.multi_face_landmarks[0].landmark
-            
-            # Calculate the distance between corresponding landmarks
-            total_distance = 0
-            count = 0
-            
-            # Compare key facial features (eyes, nose, mouth)
-            key_indices = [1, 33, 263, 61, 291, 13, 14]  # Nose tip, eye corners, mouth corners
-            
-            for idx in key_indices:
-                if idx < len(ref_landmarks) and idx < len(curr_landmarks):
-                    ref_point = ref_landmarks[idx]
-                    curr_point = curr_landmarks[idx]
-                    
-                    distance = np.sqrt((ref_point.x - curr_point.x)**2 + (ref_point.y - curr_point.y)**2)
-                    total_distance += distance
-                    count += 1
-            
-            if count > 0:
-                avg_distance = total_distance / count
-                # If average distance is small enough, consider it a match
-                return avg_distance < 0.1  # Threshold for landmark comparison
+        # Average distance between corresponding landmarks
+        avg_distance = np.linalg.norm(ref_coords - curr_coords, axis=1).mean()
+        # If average distance is small enough, consider it a match
+        return bool(avg_distance < 0.1)  # Threshold for landmark comparison
     
     return False
 
@@ -150,181 +446,263 @@ def get_gaze_ratio(landmarks, eye_indices, iris_index):
         logger.error(f"Error in get_gaze_ratio: {e}")
         return 0.5  # Return center if landmarks are not found
 
+# --- FaceMesh Result Cache ---
+# Within one request several checks need landmarks for the same frame, and
+# retried requests resend the same upload. Recent results are kept keyed
+# by a digest of the uploaded bytes (much smaller than the decoded frame).
+# A perceptual hash would be too coarse: it cannot see where the irises point.
+# Callers that want the result shared ask for the 5-face mesh.
+LANDMARK_CACHE_SIZE = 32
+landmark_cache = OrderedDict()
+landmark_cache_lock = threading.Lock()
+
+# Per-thread scratch buffer for the BGR->RGB conversion fed to FaceMesh
+rgb_buffers = threading.local()
+
+def to_rgb(image):
+    """
+    Convert a BGR image to RGB into a reused per-thread buffer
+    The returned array is overwritten by the next call on the same thread
+    """
+    buf = getattr(rgb_buffers, "rgb", None)
+    if buf is None or buf.shape != image.shape:
+        buf = np.empty_like(image)
+        rgb_buffers.rgb = buf
+    cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=buf)
+    return buf
+
+def frame_digest(raw):
+    # Cache key for a frame, from the raw upload bytes
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+def get_face_landmarks(image, max_faces=1, frame_key=None):
+    """
+    Run FaceMesh once on a BGR image
+    With a frame_key (see frame_digest), a cached result for the same frame
+    is reused; a 5-face result also answers a 1-face lookup
+    Returns the list of detected faces (empty if none)
+    """
+    if frame_key is not None:
+        with landmark_cache_lock:
+            cached = landmark_cache.get(frame_key)
+            if cached is not None and cached[0] >= max_faces:
+                landmark_cache.move_to_end(frame_key)
+                return cached[1][:max_faces]
+
+    # Convert the BGR image to RGB
+    results = process_face_mesh(to_rgb(image), max_faces=max_faces)
+    multi_face_landmarks = results.multi_face_landmarks or []
+
+    if frame_key is not None:
+        with landmark_cache_lock:
+            landmark_cache[frame_key] = (max_faces, multi_face_landmarks)
+            landmark_cache.move_to_end(frame_key)
+            if len(landmark_cache) > LANDMARK_CACHE_SIZE:
+                landmark_cache.popitem(last=False)
+    return multi_face_landmarks
+
+def _gaze_from_landmarks(multi_face_landmarks):
+    """
+    Check gaze direction from pre-computed face landmarks
+    Returns False on a gaze violation, otherwise True
+    """
+    if multi_face_landmarks:
+        landmarks = multi_face_landmarks[0].landmark
+        
+        # Use correct indices for eye corners
+        left_eye_corner_indices = [33, 133]  # Left eye corners
+        right_eye_corner_indices = [362, 263]  # Right eye corners
+        
+        # Calculate gaze ratio for both eyes
+        left_gaze_ratio = get_gaze_ratio(landmarks, left_eye_corner_indices, LEFT_IRIS_CENTER)
+        right_gaze_ratio = get_gaze_ratio(landmarks, right_eye_corner_indices, RIGHT_IRIS_CENTER)
+        
+        # Average the gaze ratio for more stability
+        avg_gaze_ratio = (left_gaze_ratio + right_gaze_ratio) / 2
+        
+        logger.info(f"Gaze ratios - Left: {left_gaze_ratio}, Right: {right_gaze_ratio}, Average: {avg_gaze_ratio}")
+        
+        # Check if gaze is off-center
+        if avg_gaze_ratio < HORIZONTAL_THRESHOLD or avg_gaze_ratio > (1 - HORIZONTAL_THRESHOLD):
+            return False  # Gaze violation
+        else:
+            return True  # Gaze is OK
+    return True  # No face detected, assume OK to avoid false positives
+
+def _count_faces_from_landmarks(multi_face_landmarks):
+    return len(multi_face_landmarks) if multi_face_landmarks else 0
+
+def _ears_from_landmarks(multi_face_landmarks, image_shape):
+    """
+    Approximate ear positions in pixel coordinates
+    Returns (left_ear, right_ear), or None if no face was detected
+    """
+    if not multi_face_landmarks:
+        return None
+    landmarks = multi_face_landmarks[0].landmark
+    h, w = image_shape[:2]
+    
+    # Approximate ear positions using more accurate landmarks
+    left_ear = (int(landmarks[93].x * w), int(landmarks[93].y * h))
+    right_ear = (int(landmarks[323].x * w), int(landmarks[323].y * h))
+    return left_ear, right_ear
+
 def detect_gaze(image):
-    with mp_face_mesh.FaceMesh(
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5
-    ) as face_mesh:
-        # Convert the BGR image to RGB
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        results = face_mesh.process(rgb_image)
-
-        if results.multi_face_landmarks:
-            landmarks = results.multi_face_landmarks[0].landmark
-            
-            # Use correct indices for eye corners
-            left_eye_corner_indices = [33, 133]  # Left eye corners
-            right_eye_corner_indices = [362, 263]  # Right eye corners
-            
-            # Calculate gaze ratio for both eyes
-            left_gaze_ratio = get_gaze_ratio(landmarks, left_eye_corner_indices, LEFT_IRIS_CENTER)
-            right_gaze_ratio = get_gaze_ratio(landmarks, right_eye_corner_indices, RIGHT_IRIS_CENTER)
-            
-            # Average the gaze ratio for more stability
-            avg_gaze_ratio = (left_gaze_ratio + right_gaze_ratio) / 2
-            
-            logger.info(f"Gaze ratios - Left: {left_gaze_ratio}, Right: {right_gaze_ratio}, Average: {avg_gaze_ratio}")
-            
-            # Check if gaze is off-center
-            if avg_gaze_ratio < HORIZONTAL_THRESHOLD or avg_gaze_ratio > (1 - HORIZONTAL_THRESHOLD):
-                return False  # Gaze violation
-            else:
-                return True  # Gaze is OK
-        return True  # No face detected, assume OK to avoid false positives
+    return _gaze_from_landmarks(get_face_landmarks(image))
 
 def detect_multiple_faces(image):
     """
     Detect if there are multiple faces in the image
     Returns True if multiple faces are detected, otherwise False
     """
-    with mp_face_mesh.FaceMesh(
-        max_num_faces=5,  # Increase max_num_faces to detect multiple faces
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5
-    ) as face_mesh:
-        # Convert the BGR image to RGB
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        results = face_mesh.process(rgb_image)
-
-        # Check if multiple faces are detected
-        if results.multi_face_landmarks and len(results.multi_face_landmarks) > 1:
-            return True
-        return False
+    # Use the 5-face mesh to detect multiple faces
+    return _count_faces_from_landmarks(get_face_landmarks(image, max_faces=5)) > 1
 
-def detect_prohibited_items(image):
+def detect_yolo_items(image, yolo_future=None):
     """
-    Detect prohibited items in the image using YOLO
+    Detect COCO prohibited items in the image using YOLO
+    yolo_future may hold a submit_yolo call for this image that was started earlier
     Returns the violation type if any prohibited item is found, otherwise None
     """
     if model is None:
-        logger.error("YOLO model not loaded")
         return None
         
     try:
-        # Run YOLO detection with confidence threshold
-        results = model(image, verbose=False, conf=0.5)
+        # Run YOLO detection with confidence threshold (batched with other requests)
+        if yolo_future is None:
+            yolo_future = submit_yolo(image)
+        result = yolo_future.result()
         
         # Check if any prohibited items are detected
-        for result in results:
-            boxes = result.boxes
-            for box in boxes:
-                # Get class name and confidence
-                cls = int(box.cls[0])
-                conf = float(box.conf[0])
-                class_name = model.names[cls]
-                
-                logger.info(f"Detected object: {class_name} with confidence: {conf}")
-                
-                # Check if this is a prohibited item with sufficient confidence
-                if class_name.lower() in PROHIBITED_ITEMS and conf > 0.5:
-                    return PROHIBITED_ITEMS[class_name.lower()]
+        for box in result.boxes:
+            # Get class name and confidence
+            cls = int(box.cls[0])
+            conf = float(box.conf[0])
+            class_name = model.names[cls]
+            
+            logger.info(f"Detected object: {class_name} with confidence: {conf}")
+            
+            # Check if this is a prohibited item with sufficient confidence
+            if class_name.lower() in PROHIBITED_ITEMS and conf > 0.5:
+                return PROHIBITED_ITEMS[class_name.lower()]
         
-        # Special detection for airpods/headsets (not in COCO dataset)
-        return detect_airpods_headsets(image)
+        return None
         
     except Exception as e:
         logger.error(f"Error in object detection: {e}")
         return None
 
-def detect_airpods_headsets(image):
+def detect_prohibited_items(image, multi_face_landmarks=None, yolo_future=None):
+    """
+    Detect prohibited items in the image using YOLO, then airpods/headsets
+    yolo_future may hold a submit_yolo call for this image that was started earlier
+    Returns the violation type if any prohibited item is found, otherwise None
+    """
+    if model is None:
+        logger.error("YOLO model not loaded")
+        return None
+    
+    item = detect_yolo_items(image, yolo_future)
+    if item:
+        return item
+    
+    # Special detection for airpods/headsets (not in COCO dataset)
+    return detect_airpods_headsets(image, multi_face_landmarks)
+
+# Max distance in pixels between a blob and an ear landmark
+EAR_DISTANCE = 70
+
+# Define range for white color (airpods are typically white)
+LOWER_WHITE = np.array([0, 0, 200])
+UPPER_WHITE = np.array([180, 30, 255])
+
+# Define range for black color (headsets are typically black)
+LOWER_BLACK = np.array([0, 0, 0])
+UPPER_BLACK = np.array([180, 255, 30])
+
+# Extra pixels cropped around the ear patch, so a blob near the ear is seen whole
+EAR_PATCH_MARGIN = 30
+
+def _object_near_ear(image, ear):
+    """
+    Look for a white or black blob around a single ear position
+    Only a patch of EAR_DISTANCE + EAR_PATCH_MARGIN around the ear is
+    converted and thresholded
+    """
+    h, w = image.shape[:2]
+    ex, ey = ear
+    radius = EAR_DISTANCE + EAR_PATCH_MARGIN
+    x0, y0 = min(w, max(0, ex - radius)), min(h, max(0, ey - radius))
+    x1, y1 = min(w, max(0, ex + radius)), min(h, max(0, ey + radius))
+    roi = image[y0:y1, x0:x1]
+    if roi.size == 0:
+        return False  # Ear is outside the frame
+    
+    # Convert to HSV for better color detection
+    hsv = cv2.cvtColor(roi, cv2.COLOR_BGR2HSV)
+    
+    # Threshold the HSV patch to get white and black colors and combine masks
+    white_mask = cv2.inRange(hsv, LOWER_WHITE, UPPER_WHITE)
+    black_mask = cv2.inRange(hsv, LOWER_BLACK, UPPER_BLACK)
+    mask = cv2.bitwise_or(white_mask, black_mask)
+    
+    # Label connected blobs in the mask; stats and centroids come back as arrays
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    
+    # Skip label 0, which is the background
+    stats = stats[1:]
+    areas = stats[:, cv2.CC_STAT_AREA]
+    cx = centroids[1:, 0]
+    cy = centroids[1:, 1]
+    
+    # Filter out very small and very large blobs
+    sized = (areas > 50) & (areas < 500)
+    
+    # Blobs touching a cut edge of the patch are pieces of larger regions
+    # (hair, dark background), so their area is not trustworthy. Edges that
+    # are also image borders are kept, as in a full-frame check.
+    left = stats[:, cv2.CC_STAT_LEFT]
+    top = stats[:, cv2.CC_STAT_TOP]
+    right = left + stats[:, cv2.CC_STAT_WIDTH]
+    bottom = top + stats[:, cv2.CC_STAT_HEIGHT]
+    cut = (((left == 0) & (x0 > 0)) | ((top == 0) & (y0 > 0)) |
+           ((right == roi.shape[1]) & (x1 < w)) | ((bottom == roi.shape[0]) & (y1 < h)))
+    
+    # Check if any blob is near the ear (squared distances, no sqrt needed)
+    dist = (cx - (ex - x0))**2 + (cy - (ey - y0))**2
+    return bool(np.any(sized & ~cut & (dist < EAR_DISTANCE**2)))
+
+def detect_airpods_headsets(image, multi_face_landmarks=None):
     """
     Improved detection for airpods/headsets using color and position
+    Reuses multi_face_landmarks when the caller already ran FaceMesh
     """
     try:
-        # Convert to HSV for better color detection
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        
-        # Define range for white color (airpods are typically white)
-        lower_white = np.array([0, 0, 200])
-        upper_white = np.array([180, 30, 255])
-        
-        # Define range for black color (headsets are typically black)
-        lower_black = np.array([0, 0, 0])
-        upper_black = np.array([180, 255, 30])
-        
-        # Threshold the HSV image to get white and black colors
-        white_mask = cv2.inRange(hsv, lower_white, upper_white)
-        black_mask = cv2.inRange(hsv, lower_black, upper_black)
-        
-        # Combine masks
-        mask = cv2.bitwise_or(white_mask, black_mask)
-        
-        # Find contours in the mask
-        contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        
         # Get face landmarks to determine ear positions
-        with mp_face_mesh.FaceMesh(
-            max_num_faces=1,
-            refine_landmarks=True,
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5
-        ) as face_mesh:
-            # Convert the BGR image to RGB
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            results = face_mesh.process(rgb_image)
-            
-            if results.multi_face_landmarks:
-                landmarks = results.multi_face_landmarks[0].landmark
-                h, w, _ = image.shape
-                
-                # Approximate ear positions using more accurate landmarks
-                left_ear = (int(landmarks[93].x * w), int(landmarks[93].y * h))
-                right_ear = (int(landmarks[323].x * w), int(landmarks[323].y * h))
-                
-                # Check if any contours are near the ears
-                for contour in contours:
-                    area = cv2.contourArea(contour)
-                    if 50 < area < 500:  # Filter out very small and very large contours
-                        M = cv2.moments(contour)
-                        if M["m00"] != 0:
-                            cx = int(M["m10"] / M["m00"])
-                            cy = int(M["m01"] / M["m00"])
-                            
-                            # Check if this object is near either ear
-                            left_dist = np.sqrt((cx - left_ear[0])**2 + (cy - left_ear[1])**2)
-                            right_dist = np.sqrt((cx - right_ear[0])**2 + (cy - right_ear[1])**2)
-                            
-                            # If the object is close to an ear, it might be an airpod or headset
-                            if left_dist < 70 or right_dist < 70:
-                                return "AIRPODS_OR_HEADSET"
+        if multi_face_landmarks is None:
+            multi_face_landmarks = get_face_landmarks(image)
+        ears = _ears_from_landmarks(multi_face_landmarks, image.shape)
+        if not ears:
+            return None
+        
+        # If an object is close to an ear, it might be an airpod or headset
+        for ear in ears:
+            if _object_near_ear(image, ear):
+                return "AIRPODS_OR_HEADSET"
         
         return None
     except Exception as e:
         logger.error(f"Error in airpods/headset detection: {e}")
         return None
 
-def detect_face(image):
+def detect_face(image, frame_key=None):
     """
     Detect if there is a face in the image
     Returns True if a face is detected, otherwise False
     """
-    with mp_face_mesh.FaceMesh(
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5
-    ) as face_mesh:
-        # Convert the BGR image to RGB
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        results = face_mesh.process(rgb_image)
-
-        # Check if a face is detected
-        if results.multi_face_landmarks:
-            return True
-        return False
+    # Check if a face is detected
+    # Use the 5-face mesh so the result is shared with compare_faces
+    return _count_faces_from_landmarks(get_face_landmarks(image, max_faces=5, frame_key=frame_key)) > 0
 
 @app.route("/validate-face", methods=["POST"])
 def validate_face():
@@ -334,18 +712,20 @@ def validate_face():
     if not img_data:
         return "ERROR", 400
 
-    curr_path = save_image_from_base64(img_data)
-    
-    # Load the image for analysis
-    image = cv2.imread(curr_path)
+    # Decode the image for analysis and archive the original bytes
+    image, raw = decode_image_from_base64(img_data)
+    if image is None:
+        return "ERROR", 400
+    archive_image(raw, image_extension(img_data))
+    frame_key = frame_digest(raw)
     
     # Check if a face is detected
-    if not detect_face(image):
+    if not detect_face(image, frame_key):
         return "NO_FACE_DETECTED"
     
     # If reference face is provided, compare faces
     if reference_face_path and os.path.exists(reference_face_path):
-        if compare_faces(reference_face_path, curr_path):
+        if compare_faces(reference_face_path, image, frame_key):
             return "FACE_MATCH"
         else:
             return "NO_FACE_MATCH"
@@ -363,10 +743,11 @@ def capture():
     if not img_data or not username:
         return "ERROR", 400
 
-    curr_path = save_image_from_base64(img_data)
-    
-    # Load the image for analysis
-    image = cv2.imread(curr_path)
+    # Decode the image for analysis and archive the original bytes
+    image, raw = decode_image_from_base64(img_data)
+    if image is None:
+        return "ERROR", 400
+    archive_image(raw, image_extension(img_data))
     
     # Check for multiple faces in the first image as well
     if reference_face_path is None:
@@ -375,44 +756,53 @@ def capture():
             return "MULTIPLE_FACES"
         return "OK"
 
-    # 1. Check for multiple faces first
-    if detect_multiple_faces(image):
-        logger.info(f"Multiple faces detected for user {username}")
-        return "MULTIPLE_FACES"
+    # Checks run cheapest first so a violation skips the detector work after it
+
+    # 1. Check for noise violation (already decided by the frontend)
+    if noise_violation == "true":
+        logger.info(f"Noise violation for user {username}")
+        count = record_violation(username)
+        if count >= MAX_VIOLATIONS:
+            return "MAX_VIOLATIONS"
+        return f"VIOLATION:NOISE_VIOLATION:{count}"
+
+    # Template matching and YOLO are independent and both release the GIL,
+    # so run them side by side instead of one after the other. YOLO already
+    # runs on the batcher thread, so only compare_faces needs the pool.
+    yolo_future = submit_yolo(image) if model is not None else None
+    frame_key = frame_digest(raw)
+    match_future = detector_pool.submit(compare_faces, reference_face_path, image, frame_key)
 
     # 2. Check for face mismatch with the reference face from login
-    if not compare_faces(reference_face_path, curr_path):
+    if not match_future.result():
         logger.info(f"Face mismatch for user {username}")
         return "FACE_MISMATCH"
 
-    # 3. Check for prohibited items
-    prohibited_item = detect_prohibited_items(image)
-    if prohibited_item:
-        logger.info(f"Prohibited item detected for user {username}: {prohibited_item}")
-        violation_counts[username] += 1
-        count = violation_counts[username]
-        if count >= MAX_VIOLATIONS:
-            return "MAX_VIOLATIONS"
-        # Return in the format expected by the frontend
-        return f"VIOLATION:PROHIBITED_ITEM:{prohibited_item}:{count}"
+    # Run FaceMesh once; every face-based check below reuses these landmarks
+    multi_face_landmarks = get_face_landmarks(image, max_faces=5, frame_key=frame_key)
+
+    # 3. Check for multiple faces
+    if _count_faces_from_landmarks(multi_face_landmarks) > 1:
+        logger.info(f"Multiple faces detected for user {username}")
+        return "MULTIPLE_FACES"
 
     # 4. Check for gaze violation
-    if not detect_gaze(image):
+    if not _gaze_from_landmarks(multi_face_landmarks):
         logger.info(f"Gaze violation for user {username}")
-        violation_counts[username] += 1
-        count = violation_counts[username]
+        count = record_violation(username)
         if count >= MAX_VIOLATIONS:
             return "MAX_VIOLATIONS"
         return f"VIOLATION:GAZE_VIOLATION:{count}"
 
-    # 5. Then, check for noise violation
-    if noise_violation == "true":
-        logger.info(f"Noise violation for user {username}")
-        violation_counts[username] += 1
-        count = violation_counts[username]
+    # 5. Check for prohibited items (YOLO result from the pool, then airpods/headsets)
+    prohibited_item = detect_prohibited_items(image, multi_face_landmarks, yolo_future)
+    if prohibited_item:
+        logger.info(f"Prohibited item detected for user {username}: {prohibited_item}")
+        count = record_violation(username)
         if count >= MAX_VIOLATIONS:
             return "MAX_VIOLATIONS"
-        return f"VIOLATION:NOISE_VIOLATION:{count}"
+        # Return in the format expected by the frontend
+        return f"VIOLATION:PROHIBITED_ITEM:{prohibited_item}:{count}"
 
     # If all checks pass
     logger.info(f"No violations for user {username}")
@@ -425,8 +815,7 @@ def fullscreen_violation():
     username = request.form.get("username")
     if not username: return "ERROR", 400
     
-    violation_counts[username] += 1
-    count = violation_counts[username]
+    count = record_violation(username)
     
     if count >= MAX_VIOLATIONS:
         return "MAX_VIOLATIONS"
@@ -438,8 +827,7 @@ def tab_change_violation():
     username = request.form.get("username")
     if not username: return "ERROR", 400
         
-    violation_counts[username] += 1
-    count = violation_counts[username]
+    count = record_violation(username)
     
     if count >= MAX_VIOLATIONS:
         return "MAX_VIOLATIONS"
@@ -451,8 +839,7 @@ def window_change_violation():
     username = request.form.get("username")
     if not username: return "ERROR", 400
         
-    violation_counts[username] += 1
-    count = violation_counts[username]
+    count = record_violation(username)
     
     if count >= MAX_VIOLATIONS:
         return "MAX_VIOLATIONS"
@@ -469,4 +856,5 @@ def submit_exam():
     return "OK"
 
 if __name__ == "__main__":
-    app.run(port=5000, debug=True)
\ No newline at end of file
+    # Local development only; deploy with gunicorn -c gunicorn_conf.py face_service:app
+    app.run(port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,17 @@
+# Gunicorn settings for face_service
+# Run with: gunicorn -c gunicorn_conf.py face_service:app
+import os
+
+# The Go backend talks to the service on localhost:5000
+bind = os.environ.get("FACE_SERVICE_BIND", "127.0.0.1:5000")
+
+# Violation counts are only shared between processes through Redis, so
+# stay on a single worker unless REDIS_URL is set
+workers = int(os.environ.get("GUNICORN_WORKERS", 2 if os.environ.get("REDIS_URL") else 1))
+worker_class = "gthread"
+# face_service sizes its detector pool from the same variable
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 30
+
+# No preload_app: the YOLO batcher and image archiver start background
+# threads at import time, which must happen inside each worker